@@ -1,33 +1,44 @@
 import argparse
 import sys
-import json
+import time
+import random
 import socket
+import concurrent.futures
 from enum import Enum
 
-import googleapiclient.discovery
-import google.auth.exceptions
-
-import utils
-
 class OBInstType(Enum):
     SERVER = 1
     CLIENT = 2
 
+SCOPE_PREFIX = "https://www.googleapis.com/auth/"
+
+# Return True when the user passed a pre-resolved resource path (a
+# partial or full URL) rather than a bare resource name
+def is_resolved_path(value):
+    return value.startswith(("projects/", "global/", "regions/", "https://"))
+
 class OBOptions:
     def __init__(self, args):
         self.project = args.project
         self.region = args.region
         self.zone = args.zone
-        self.image = f"global/images/{args.image}"
+        # pass pre-resolved paths through untouched; qualify bare names
+        # fully, which skips a server-side project resolution step
+        # during bulkInsert
+        if is_resolved_path(args.image):
+            self.image = args.image
+        else:
+            self.image = f"projects/{args.project}/global/images/{args.image}"
 
-        self.scopes = []
-        for item in args.scopes:
-            self.scopes.append(f"https://www.googleapis.com/auth/{item}")
+        self.scopes = [SCOPE_PREFIX + item for item in args.scopes]
 
-        if args.subnet:
-            self.subnet = f"regions/{args.region}/subnetworks/{args.subnet}"
-        else:
+        if not args.subnet:
             self.subnet = None
+        elif is_resolved_path(args.subnet):
+            self.subnet = args.subnet
+        else:
+            self.subnet = (f"projects/{args.project}/regions/{args.region}"
+                           f"/subnetworks/{args.subnet}")
 
         if args.enable_tier1_networking and args.nic_type != "GVNIC":
             print("Warning: Setting nic-type to \"GVNIC\" for Tier 1 networking.")
@@ -40,6 +51,7 @@ class OBOptions:
 
         self.server = {
             "count": args.num_servers,
+            "min_count": args.min_servers,
             "type": args.server_type,
             "prefix": args.server_prefix,
             "num_ssd_per": args.num_ssd_per_server
@@ -51,6 +63,7 @@ class OBOptions:
 
         self.client = {
             "count": args.num_clients,
+            "min_count": args.min_clients,
             "type": args.client_type,
             "prefix": args.client_prefix
         }
@@ -89,9 +102,9 @@ def initialize_parser():
     parser.add_argument(
             "--scopes",
             required=True,
-            action="append",
+            nargs="+",
             metavar="SCOPE",
-            help="GCP access scope to be applied to instances")
+            help="GCP access scopes to be applied to instances")
     parser.add_argument(
             "-s", "--subnet",
             default=None,
@@ -123,6 +136,20 @@ def initialize_parser():
             required=True,
             type=int,
             help="number of clients to create")
+    parser.add_argument(
+            "--min-servers",
+            type=int,
+            default=None,
+            help="minimum acceptable number of servers; when less than "
+                 "--num-servers, the create returns as soon as this many "
+                 "exist instead of waiting out capacity shortages")
+    parser.add_argument(
+            "--min-clients",
+            type=int,
+            default=None,
+            help="minimum acceptable number of clients; when less than "
+                 "--num-clients, the create returns as soon as this many "
+                 "exist instead of waiting out capacity shortages")
     parser.add_argument(
             "--server-type",
             required=True,
@@ -170,6 +197,15 @@ def initialize_parser():
             "--output-file",
             default=None,
             help="file to write names of created instances to")
+    parser.add_argument(
+            "--refresh-discovery",
+            action="store_true",
+            help="re-download the cached API discovery documents")
+    parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="verify inputs even if this configuration recently "
+                 "verified successfully")
 
     return parser
 
@@ -223,37 +259,63 @@ def stringify_startup_script(filename):
     return script_text
 
 # Verify user-specified Google Cloud resources
-def verify_inputs(args):
-    # required inputs
-    if (not utils.verify_project(args.project)
-            or not utils.verify_region(args.project, args.region)
-            or not utils.verify_zone(args.project, args.region, args.zone)
-            or not utils.verify_image(args.project, args.image)):
-        return False
-
-    if (not utils.verify_machine_type(
-            args.project, args.zone, args.server_type)):
-        return False
-
-    if (not utils.verify_machine_type(
-            args.project, args.zone, args.client_type)):
-        return False
+#
+# Every compute check is an independent GET, so they all travel in a
+# single batched round-trip. The project check goes through the
+# Resource Manager API, which can't join the batch, so it runs in a
+# worker thread while the batch executes - total latency is one
+# round-trip instead of two (or eight, when everything was serial).
+#
+# Successful verifications are cached on disk for an hour, keyed by the
+# full set of inputs, so repeated runs against the same configuration
+# skip the round-trips altogether (bypass with --no-cache).
+def verify_inputs(compute, args):
+    cache_key = "|".join(str(v) for v in (
+            args.project, args.region, args.zone, args.image,
+            args.server_type, args.client_type, args.subnet,
+            args.server_policy, args.client_policy))
+    if not args.no_cache and utils.check_verify_cache(cache_key):
+        return True
+
+    results = []
+    batch = compute.new_batch_http_request()
+
+    # required inputs; pre-resolved paths skip their verify round-trip
+    # since bulkInsert reports a clear error if they turn out wrong
+    utils.verify_region(compute, batch, results, args.project, args.region)
+    utils.verify_zone(
+            compute, batch, results, args.project, args.region, args.zone)
+    if not is_resolved_path(args.image):
+        utils.verify_image(compute, batch, results, args.project, args.image)
+    utils.verify_machine_type(
+            compute, batch, results, args.project, args.zone, args.server_type)
+    utils.verify_machine_type(
+            compute, batch, results, args.project, args.zone, args.client_type)
 
     # optional inputs
-    if (args.subnet
-            and not utils.verify_subnet(args.project, args.region, args.subnet)):
-        return False
-
-    if (args.server_policy
-            and not utils.verify_policy(
-                args.project, args.region, args.server_policy)):
-        return False
-    if (args.client_policy
-            and not utils.verify_policy(
-                args.project, args.region, args.client_policy)):
-        return False
-
-    return True
+    if args.subnet and not is_resolved_path(args.subnet):
+        utils.verify_subnet(
+                compute, batch, results, args.project, args.region, args.subnet)
+    if args.server_policy and not is_resolved_path(args.server_policy):
+        utils.verify_policy(
+                compute, batch, results,
+                args.project, args.region, args.server_policy)
+    if args.client_policy and not is_resolved_path(args.client_policy):
+        utils.verify_policy(
+                compute, batch, results,
+                args.project, args.region, args.client_policy)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        project_future = executor.submit(
+                utils.verify_project, args.project,
+                refresh=args.refresh_discovery)
+        batch.execute()
+        project_ok = project_future.result()
+
+    verified = project_ok and all(ok for _, ok in results)
+    if verified and not args.no_cache:
+        utils.update_verify_cache(cache_key)
+    return verified
 
 def setup_network_interface(opts):
     network_interface = {
@@ -294,26 +356,36 @@ def setup_disks(opts, is_server):
     disks = [boot_disk]
 
     if is_server and opts.server["num_ssd_per"] > 0:
-        local_disk = {
-            "type": "SCRATCH",
-            "initializeParams": {
-                "diskType": "local-ssd"
-            },
-            "autoDelete": "true",
-            "interface": "NVME"
-        }
-        local_disks = [local_disk] * opts.server["num_ssd_per"]
-        disks += local_disks
+        # build an independent dict per disk - list multiplication
+        # would alias one shared dict N times - and give each a unique
+        # deviceName, which GCE requires when attaching more than one
+        # local SSD
+        disks += [
+            {
+                "type": "SCRATCH",
+                "initializeParams": {
+                    "diskType": "local-ssd"
+                },
+                "autoDelete": "true",
+                "interface": "NVME",
+                "deviceName": f"local-ssd-{i}"
+            }
+            for i in range(opts.server["num_ssd_per"])
+        ]
 
     return disks
 
-def setup_instance_properties(opts, is_server, net_int, disks):
-    instance_properties = {
+# Build the instance properties shared by server and client pools
+#
+# Constructed once in __main__ and merged into each pool's properties,
+# so the subtrees that don't depend on instance type aren't rebuilt per
+# submission.
+def setup_base_properties(opts, net_int):
+    base_properties = {
         "advancedMachineFeatures": {
             "threadsPerCore": opts.threads_per_core
         },
         "networkInterfaces": [net_int],
-        "disks": disks,
         "serviceAccounts": [
             {
                 "scopes": opts.scopes
@@ -321,21 +393,24 @@ def setup_instance_properties(opts, is_server, net_int, disks):
         ]
     }
 
-    if is_server:
-        instance_properties["machineType"] = opts.server["type"]
-        if "metadata" in opts.server:
-            instance_properties["metadata"] = opts.server["metadata"]
-        if "policy" in opts.server:
-            instance_properties["resourcePolicies"] = [opts.server["policy"]]
-    else:
-        instance_properties["machineType"] = opts.client["type"]
-        if "metadata" in opts.client:
-            instance_properties["metadata"] = opts.client["metadata"]
-        if "policy" in opts.client:
-            instance_properties["resourcePolicies"] = [opts.client["policy"]]
-
-    if "resourcePolicies" in instance_properties:
-        instance_properties["scheduling"] = {
+    if opts.enable_tier1_networking:
+        base_properties["networkPerformanceConfig"] = {
+            "totalEgressBandwidthTier": "TIER_1"
+        }
+
+    return base_properties
+
+def setup_instance_properties(opts, is_server, base_properties, disks):
+    pool = opts.server if is_server else opts.client
+
+    # collect the conditional fields first so the merge below is a
+    # single dict construction
+    optional = {}
+    if "metadata" in pool:
+        optional["metadata"] = pool["metadata"]
+    if "policy" in pool:
+        optional["resourcePolicies"] = [pool["policy"]]
+        optional["scheduling"] = {
             "onHostMaintenance": "TERMINATE",
             "automaticRestart": "false"
         }
@@ -346,23 +421,27 @@ def setup_instance_properties(opts, is_server, net_int, disks):
             "value": opts.startup_script
         }
 
-        if "metadata" in instance_properties:
-            instance_properties["metadata"]["items"].append(startup_metadata)
+        if "metadata" in optional:
+            optional["metadata"]["items"].append(startup_metadata)
         else:
-            instance_properties["metadata"] = {
+            optional["metadata"] = {
                 "items": [startup_metadata]
             }
 
-    if opts.enable_tier1_networking:
-        instance_properties["networkPerformanceConfig"] = {
-            "totalEgressBandwidthTier": "TIER_1"
-        }
+    return {
+        **base_properties,
+        "machineType": pool["type"],
+        "disks": disks,
+        **optional
+    }
 
-    return instance_properties
+# HTTP statuses worth retrying in the operation-wait loop
+RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
 
 def wait_for_operation(compute, operation, opts):
     print(f"Waiting for {operation['operationType']} operation to finish...",
           end=" ", flush=True)
+    attempt = 0
     while True:
         try:
             result = compute.zoneOperations().wait(
@@ -372,7 +451,18 @@ def wait_for_operation(compute, operation, opts):
         except (TimeoutError, socket.timeout):
             print("\b.", end=" ", flush=True)
             continue
+        except googleapiclient.errors.HttpError as e:
+            if e.resp.status not in RETRIABLE_STATUSES:
+                raise
+            # transient server error - back off with jitter and retry;
+            # wait() itself long-polls, so this only adds delay when
+            # the API is having trouble
+            time.sleep(min(60, 2 ** attempt) + random.uniform(0, 1))
+            attempt += 1
+            print("\b.", end=" ", flush=True)
+            continue
 
+        attempt = 0
         if result['status'] == 'DONE':
             print("done.")
             if 'error' in result:
@@ -393,11 +483,10 @@ def get_instances_from_group_id(compute, group_id, opts):
         op_list = compute.zoneOperations().list(
             project=opts.project,
             zone=opts.zone,
-            filter=filter_expr).execute()
+            filter=filter_expr).execute(num_retries=3)
     except googleapiclient.errors.HttpError as e:
-        error_msg = json.loads(e.content).get("error").get("message")
         print(f"Warning: Unable to retrieve operation list")
-        print(f"Error: {error_msg}")
+        print(f"Error: {utils.http_error_message(e)}")
         # sys.exit(1)
 
     # TODO: error handling
@@ -423,24 +512,32 @@ def write_instance_list(out_file, instance_list):
         for instance_name in instance_list:
             f.write(f"{instance_name}\n")
 
-def create_instances(compute, opts, network_interface, inst_type):
+# Submit a bulkInsert request for a set of instances
+#
+# Returns the operation handle without waiting for it to finish, so that
+# independent submissions (e.g. servers and clients) can be in flight at
+# the same time.
+def submit_create_instances(compute, opts, base_properties, inst_type):
     if inst_type == OBInstType.SERVER:
         is_server = True
-        count = opts.server["count"]
-        name_pattern = f'{opts.server["prefix"]}##'
+        pool = opts.server
     else:
         is_server = False
-        count = opts.client["count"]
-        name_pattern = f'{opts.client["prefix"]}##'
+        pool = opts.client
 
     disks = setup_disks(opts, is_server)
     instance_properties = setup_instance_properties(
-            opts, is_server, network_interface, disks)
+            opts, is_server, base_properties, disks)
     body = {
-        "count": count,
-        "namePattern": name_pattern,
+        "count": pool["count"],
+        "namePattern": f'{pool["prefix"]}##',
         "instanceProperties": instance_properties
     }
+    # with minCount below count, GCE returns once minCount instances
+    # exist rather than blocking on stragglers or failing outright when
+    # the zone can't satisfy the full request
+    if pool["min_count"]:
+        body["minCount"] = pool["min_count"]
 
     try:
         operation = compute.instances().bulkInsert(
@@ -448,11 +545,28 @@ def create_instances(compute, opts, network_interface, inst_type):
             zone=opts.zone,
             body=body).execute()
     except googleapiclient.errors.HttpError as e:
-        error_msg = json.loads(e.content).get("error").get("message")
-        print(f"Error: {error_msg}")
+        print(f"Error: {utils.http_error_message(e)}")
         sys.exit(1)
 
-    result = wait_for_operation(compute, operation, opts)
+    return operation
+
+# Wait for a previously submitted bulkInsert operation to finish and
+# return the names of the instances it created
+#
+# Builds its own service object because this runs in a worker thread and
+# the discovery client is not thread-safe.
+def finish_create_instances(operation, opts):
+    compute = utils.build_discovery_service_object("compute", "v1")
+    # bulkInsert can return an already-DONE operation when GCE satisfies
+    # the request immediately; skip the wait round-trip in that case
+    if operation.get('status') == 'DONE':
+        print(f"{operation['operationType']} operation done (synchronous).")
+        if 'error' in operation:
+            print(operation['error'])
+            raise Exception(operation['error'])
+        result = operation
+    else:
+        result = wait_for_operation(compute, operation, opts)
     return get_instances_from_group_id(compute,
                                        result['operationGroupId'],
                                        opts)
@@ -465,35 +579,48 @@ if __name__ == "__main__":
         print("Error: Must specify at least one server or client.")
         sys.exit(1)
 
-    if not verify_inputs(args):
+    if args.min_servers and args.min_servers > args.num_servers:
+        print("Error: --min-servers cannot exceed --num-servers.")
+        sys.exit(1)
+    if args.min_clients and args.min_clients > args.num_clients:
+        print("Error: --min-clients cannot exceed --num-clients.")
         sys.exit(1)
-    ob_opts = OBOptions(args)
 
-    try:
-        compute = googleapiclient.discovery.build('compute', 'v1')
-    except google.auth.exceptions.DefaultCredentialsError:
-        print(
-            "No Google application credentials.\n"
-            "Please do one of the following before re-running the script:\n"
-            "1) Run `gcloud auth application-default login`\n"
-            "OR\n"
-            "2) Set the GOOGLE_APPLICATION_CREDENTIALS environment variable\n"
-        )
+    # deferred until the arguments are known to be sane - importing the
+    # google client libraries costs ~100ms, which would otherwise be
+    # paid even for --help and bad-argument runs
+    import googleapiclient.errors
+    import utils
+
+    compute = utils.build_discovery_service_object(
+            "compute", "v1", refresh=args.refresh_discovery)
+
+    if not verify_inputs(compute, args):
         sys.exit(1)
+    ob_opts = OBOptions(args)
 
     net_int = setup_network_interface(ob_opts)
+    base_props = setup_base_properties(ob_opts, net_int)
 
-    instances = []
+    # submit both bulkInsert requests up front, then wait on them
+    # concurrently so server and client provisioning overlap
+    operations = []
     if args.num_servers > 0:
-        servers = create_instances(compute, ob_opts, net_int, OBInstType.SERVER)
-        if ob_opts.list_instances:
-            print_instance_list(servers)
-        instances.extend(servers)
+        operations.append(submit_create_instances(
+                compute, ob_opts, base_props, OBInstType.SERVER))
     if args.num_clients > 0:
-        clients = create_instances(compute, ob_opts, net_int, OBInstType.CLIENT)
-        if ob_opts.list_instances:
-            print_instance_list(clients)
-        instances.extend(clients)
+        operations.append(submit_create_instances(
+                compute, ob_opts, base_props, OBInstType.CLIENT))
+
+    instances = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(finish_create_instances, op, ob_opts)
+                   for op in operations]
+        for future in futures:
+            created = future.result()
+            if ob_opts.list_instances:
+                print_instance_list(created)
+            instances.extend(created)
 
     if ob_opts.output_file:
         write_instance_list(ob_opts.output_file, instances)
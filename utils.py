@@ -1,13 +1,64 @@
+import os
 import sys
 import json
+import time
+import urllib.request
 
+import httplib2
 import googleapiclient.discovery
 import googleapiclient.errors
+import google.auth
 import google.auth.exceptions
+import google_auth_httplib2
+
+# orjson parses the nested GCE error payloads noticeably faster than
+# the stdlib; fall back quietly when it isn't installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Pull the human-readable message out of an HttpError payload
+#
+# Malformed payloads fall back to the exception's own string rather
+# than masking the real HTTP status with a parse error.
+def http_error_message(e):
+    try:
+        return json_loads(e.content).get("error", {}).get("message", str(e))
+    except ValueError:
+        return str(e)
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "orangefs-io500")
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/{service}/{version}/rest"
+VERIFY_CACHE_PATH = os.path.join(CACHE_DIR, "verify.json")
+VERIFY_CACHE_TTL = 60 * 60  # seconds
+
+# Fetch the discovery document for a service, caching it on disk
+#
+# googleapiclient normally downloads the document (~3MB for compute v1)
+# over HTTPS on every build() call, which is the largest fixed cost for
+# a short-lived script. Pass refresh=True to re-download a stale copy.
+def get_discovery_document(service, version, refresh=False):
+    cache_path = os.path.join(CACHE_DIR, f"{service}-{version}.json")
+
+    if refresh or not os.path.exists(cache_path):
+        url = DISCOVERY_URL.format(service=service, version=version)
+        with urllib.request.urlopen(url) as response:
+            document = response.read()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            f.write(document)
+    else:
+        with open(cache_path, 'rb') as f:
+            document = f.read()
+
+    return document
 
-def build_discovery_service_object(service, version):
+def build_discovery_service_object(service, version, refresh=False):
+    document = get_discovery_document(service, version, refresh)
     try:
-        obj = googleapiclient.discovery.build(service, version)
+        credentials, _ = google.auth.default()
     except google.auth.exceptions.DefaultCredentialsError:
         print(
             "No Google application credentials.\n"
@@ -18,15 +69,72 @@ def build_discovery_service_object(service, version):
         )
         sys.exit(1)
 
-    return obj
+    # one authorized keep-alive connection per service object; every
+    # request made through it (batched verifies, bulkInsert, operation
+    # waits) reuses the same TCP/TLS session instead of re-handshaking
+    authorized_http = google_auth_httplib2.AuthorizedHttp(
+        credentials, http=httplib2.Http(timeout=180))
+
+    return googleapiclient.discovery.build_from_document(
+        document, http=authorized_http)
+
+# Check whether a set of inputs was successfully verified within the
+# cache TTL
+#
+# The cache maps a key derived from the inputs to the time they last
+# verified; a hit lets the caller skip the verify round-trips entirely.
+# A stale or mis-cached entry is harmless since bulkInsert would fail
+# with the same errors verification would have caught.
+def check_verify_cache(key):
+    try:
+        with open(VERIFY_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    timestamp = cache.get(key)
+    return (timestamp is not None
+            and time.time() - timestamp < VERIFY_CACHE_TTL)
 
-def verify_project(project_id):
+# Record that a set of inputs verified successfully
+def update_verify_cache(key):
+    try:
+        with open(VERIFY_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    cache[key] = time.time()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(VERIFY_CACHE_PATH, 'w') as f:
+        json.dump(cache, f)
+
+# Build a callback for a batched verify request
+#
+# googleapiclient invokes batch callbacks as
+# callback(request_id, response, exception); on failure we print the
+# error message and record (name, False) so the caller can aggregate
+# the results after batch.execute().
+def verify_callback(results, name):
+    def callback(request_id, response, exception):
+        if exception is None:
+            results.append((name, True))
+            return
+        if isinstance(exception, googleapiclient.errors.HttpError):
+            print(f"Error: {http_error_message(exception)}")
+        else:
+            print(f"Error: {exception}")
+        results.append((name, False))
+    return callback
+
+def verify_project(project_id, refresh=False):
     resource_manager = build_discovery_service_object(
-        "cloudresourcemanager", "v3")
+        "cloudresourcemanager", "v3", refresh=refresh)
     project_name = f"projects/{project_id}"
 
     try:
-        resource_manager.projects().get(name=project_name).execute()
+        resource_manager.projects().get(name=project_name).execute(
+            num_retries=3)
     except googleapiclient.errors.HttpError as e:
         if e.resp.status == 403:
             print(f"Error: Permission denied on project \"{project_id}\" (or it may not exist).")
@@ -38,86 +146,46 @@ def verify_project(project_id):
     else:
         return True
 
-def verify_region(project_id, region):
-    compute = build_discovery_service_object("compute", "v1")
-
-    try:
-        compute.regions().get(project=project_id, region=region).execute()
-    except googleapiclient.errors.HttpError as e:
-        error_msg = json.loads(e.content).get("error").get("message")
-        print(f"Error: {error_msg}")
-        return False
-    else:
-        return True
-
-def verify_zone(project_id, region, zone):
-    compute = build_discovery_service_object("compute", "v1")
+def verify_region(compute, batch, results, project_id, region):
+    batch.add(
+        compute.regions().get(project=project_id, region=region),
+        callback=verify_callback(results, "region"))
 
+def verify_zone(compute, batch, results, project_id, region, zone):
     if not zone.startswith(region):
         print(f"Error: Zone \"{zone}\" does not exist in \"{region}\" region.")
-        return False
+        results.append(("zone", False))
+        return
 
-    try:
-        compute.zones().get(project=project_id, zone=zone).execute()
-    except googleapiclient.errors.HttpError as e:
-        error_msg = json.loads(e.content).get("error").get("message")
-        print(f"Error: {error_msg}")
-        return False
-    else:
-        return True
+    batch.add(
+        compute.zones().get(project=project_id, zone=zone),
+        callback=verify_callback(results, "zone"))
 
-def verify_image(project_id, image_name):
-    compute = build_discovery_service_object("compute", "v1")
-    try:
-        compute.images().get(project=project_id, image=image_name).execute()
-    except googleapiclient.errors.HttpError as e:
-        error_msg = json.loads(e.content).get("error").get("message")
-        print(f"Error: {error_msg}")
-        return False
-    else:
-        return True
-
-def verify_subnet(project_id, region, subnet):
-    compute = build_discovery_service_object("compute", "v1")
+def verify_image(compute, batch, results, project_id, image_name):
+    batch.add(
+        compute.images().get(project=project_id, image=image_name),
+        callback=verify_callback(results, "image"))
 
-    try:
+def verify_subnet(compute, batch, results, project_id, region, subnet):
+    batch.add(
         compute.subnetworks().get(
             project=project_id,
             region=region,
-            subnetwork=subnet).execute()
-    except googleapiclient.errors.HttpError as e:
-        error_msg = json.loads(e.content).get("error").get("message")
-        print(f"Error: {error_msg}")
-        return False
-    else:
-        return True
-
-def verify_policy(project_id, region, policy):
-    compute = build_discovery_service_object("compute", "v1")
+            subnetwork=subnet),
+        callback=verify_callback(results, "subnet"))
 
-    try:
+def verify_policy(compute, batch, results, project_id, region, policy):
+    batch.add(
         compute.resourcePolicies().get(
             project=project_id,
             region=region,
-            resourcePolicy=policy).execute()
-    except googleapiclient.errors.HttpError as e:
-        message = json.loads(e.content).get("error").get("message")
-        print(f"Error: {message}")
-        return False
-    else:
-        return True
-
-def verify_machine_type(project_id, zone, machine_type):
-    compute = build_discovery_service_object("compute", "v1")
+            resourcePolicy=policy),
+        callback=verify_callback(results, "policy"))
 
-    try:
+def verify_machine_type(compute, batch, results, project_id, zone, machine_type):
+    batch.add(
         compute.machineTypes().get(
             project=project_id,
             zone=zone,
-            machineType=machine_type).execute()
-    except googleapiclient.errors.HttpError as e:
-        message = json.loads(e.content).get("error").get("message")
-        print(f"Error: {message}")
-        return False
-    else:
-        return True
+            machineType=machine_type),
+        callback=verify_callback(results, "machine type"))